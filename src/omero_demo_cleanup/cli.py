@@ -20,15 +20,35 @@
 
 
 import argparse
+import json
+import os
+from contextlib import nullcontext
+from copy import deepcopy
 from functools import wraps
-from typing import Any, Callable
+from time import sleep, time
+from typing import Any, Callable, ContextManager, Dict, List, Optional, Tuple
 
+import Ice
+import omero
 from omero.cli import BaseControl, Parser
 from omero.gateway import BlitzGateway
 from omero_demo_cleanup.library import (
+    SessionPool,
+    UsageCache,
+    UserStats,
     choose_users,
+    choose_users_by_cost,
+    count_objects,
     delete_data,
+    estimate_costs,
+    excess,
+    fan_out,
+    find_targets,
+    free_space,
+    read_servers,
+    remeasure,
     resource_usage,
+    shortfall,
     users_by_id_or_username,
     users_by_tag,
 )
@@ -92,6 +112,18 @@ class DemoCleanupControl(BaseControl):
             help="Perform the data deletion rather than running in dry-run mode."
             " Default: false.",
         )
+        parser.add_argument(
+            "--dry-run-level",
+            choices=("plan", "validate"),
+            default="validate",
+            help="In dry-run mode, either only count the objects to delete (plan)"
+            " or have the server check the deletion (validate). Default: validate.",
+        )
+        parser.add_argument(
+            "--counts-file",
+            help="JSON file to which validation saves how many objects would be"
+            " deleted, for --force to report progress against.",
+        )
         parser.add_argument(
             "--ignore-tag",
             "-t",
@@ -102,10 +134,159 @@ class DemoCleanupControl(BaseControl):
             "--ignore-users",
             help="Ingore users: Comma-separated IDs and/or user-names.",
         )
-        parser.set_defaults(func=self.cleanup)
+        parser.add_argument(
+            "--policy",
+            choices=("dominance", "cost"),
+            default="dominance",
+            help="Choose the users with the most data and the oldest logout"
+            " (dominance) or those who free the most for the fewest objects to"
+            " delete (cost). Default: dominance.",
+        )
+        parser.add_argument(
+            "--verify",
+            type=int,
+            default=0,
+            help="After deletion, measure the deleted users again and delete more"
+            " users if still short of the target, for up to this many rounds."
+            " Default: 0.",
+        )
+        parser.add_argument(
+            "--sessions",
+            type=int,
+            default=0,
+            help="Scan one group at a time on this many extra sessions"
+            " rather than across all groups at once. Default: 0.",
+        )
+        watch = parser.add_argument_group(
+            "watch mode", "Keep running and delete data whenever space runs low."
+        )
+        watch.add_argument(
+            "--watch",
+            default=False,
+            action="store_true",
+            help="Poll free space and delete data to restore the watermarks below."
+            " Default: false.",
+        )
+        watch.add_argument(
+            "--free-inodes",
+            type=int,
+            default=0,
+            help="How many inodes should remain free. Requires --path. Default: 0.",
+        )
+        watch.add_argument(
+            "--free-gigabytes",
+            type=int,
+            default=0,
+            help="How many bytes should remain free (in GB). Default: 0.",
+        )
+        watch.add_argument(
+            "--path",
+            help="Poll this filesystem path rather than the binary repository.",
+        )
+        watch.add_argument(
+            "--interval",
+            type=int,
+            default=300,
+            help="Seconds between polls of the free space. Default: 300.",
+        )
+        watch.add_argument(
+            "--cooldown",
+            type=int,
+            default=3600,
+            help="Seconds to wait after a cleanup before the next. Default: 3600.",
+        )
+        fleet = parser.add_argument_group(
+            "fleet mode", "Clean up several servers at the same time."
+        )
+        fleet.add_argument(
+            "--servers",
+            help="INI file with a section for each server giving its host, port,"
+            " user, password or session, and targets such as gigabytes.",
+        )
+        fleet.add_argument(
+            "--workers",
+            type=int,
+            default=0,
+            help="How many servers to clean up at once. Default: all.",
+        )
+        parser.set_defaults(func=self.run)
+
+    def run(self, args: argparse.Namespace) -> None:
+        if args.servers:
+            self.fleet(args)
+        else:
+            self.cleanup(args)
+
+    def fleet(self, args: argparse.Namespace) -> None:
+        # Each server is cleaned up with only its own profile and --force.
+        self.reject_options(
+            args,
+            "--servers: set targets and ignored users per server instead",
+            (
+                ("--days", "days", 0),
+                ("--inodes", "inodes", 0),
+                ("--gigabytes", "gigabytes", 0),
+                ("--ignore-tag", "ignore_tag", "NO DELETE"),
+                ("--ignore-users", "ignore_users", None),
+                ("--dry-run-level", "dry_run_level", "validate"),
+                ("--counts-file", "counts_file", None),
+                ("--policy", "policy", "dominance"),
+                ("--verify", "verify", 0),
+                ("--sessions", "sessions", 0),
+                ("--watch", "watch", False),
+            ),
+        )
+        if args.workers < 0:
+            self.ctx.die(29, "Please specify a positive --workers, or 0 for all")
+        try:
+            profiles = read_servers(args.servers)
+        except ValueError as e:
+            self.ctx.die(25, str(e))
+        for profile in profiles:
+            if profile.inodes == 0 and profile.gigabytes == 0:
+                self.ctx.die(23, f"Please specify how much to delete on {profile.name}")
+        if args.force:
+            self.ctx.err("Running for real: will actually delete data.")
+        else:
+            self.ctx.err("Despite output, will not actually delete any data.")
+
+        start = time()
+        reports = fan_out(profiles, dry_run=not args.force, workers=args.workers)
+        elapsed = time() - start
+
+        self.ctx.err(f"Cleaned up {len(reports)} server(s) in {elapsed:.1f} seconds.")
+        for report in reports:
+            if report.error:
+                self.ctx.err(f"{report.name}: failed: {report.error}")
+                continue
+            size = sum(user.size for user in report.users)
+            self.ctx.err(
+                f"{report.name}: {len(report.users)} user(s),"
+                f" {size / 1000**3} GB, {sum(report.deleted.values()):,} objects;"
+                f" scan {report.scan_seconds:.1f}s,"
+                f" delete {report.delete_seconds:.1f}s."
+            )
+            for user in report.users:
+                self.ctx.err(f'  "{user.name}" (#{user.id}) {user.size / 1000**3} GB')
+        if any(report.error for report in reports):
+            self.ctx.die(26, "Cleanup failed on some servers")
 
     @gateway_required
     def cleanup(self, args: argparse.Namespace) -> None:
+        if args.watch:
+            self.watch(args)
+            return
+
+        self.reject_options(
+            args,
+            "a single cleanup, without --watch",
+            (
+                ("--free-inodes", "free_inodes", 0),
+                ("--free-gigabytes", "free_gigabytes", 0),
+                ("--interval", "interval", 300),
+                ("--cooldown", "cooldown", 3600),
+            ),
+        )
         if args.inodes == 0 and args.gigabytes == 0:
             self.ctx.die(23, "Please specify how much to delete")
 
@@ -129,24 +310,255 @@ class DemoCleanupControl(BaseControl):
 
             ignore = users_by_tag(self.gateway, args.ignore_tag)
             ignore.extend(users_by_id_or_username(self.gateway, args.ignore_users))
-            stats = resource_usage(
-                self.gateway, minimum_days=args.days, ignore_users=ignore
+            with self.session_pool(args) as pool:
+                stats = resource_usage(
+                    self.gateway,
+                    minimum_days=args.days,
+                    ignore_users=ignore,
+                    pool=pool,
+                )
+                self.delete_and_verify(
+                    args, args.inodes, args.gigabytes * 1000**3, stats, pool
+                )
+        except KeyboardInterrupt:
+            pass  # ignore
+
+    def session_pool(
+        self, args: argparse.Namespace
+    ) -> ContextManager[Optional[SessionPool]]:
+        if args.sessions > 0:
+            self.ctx.err(f"Sharding queries by group across {args.sessions} sessions.")
+            return SessionPool(self.gateway, args.sessions)
+        return nullcontext()
+
+    def delete_and_verify(
+        self,
+        args: argparse.Namespace,
+        file_count: int,
+        file_size: int,
+        stats: List[UserStats],
+        pool: Optional[SessionPool] = None,
+    ) -> List[UserStats]:
+        # choose_users may zero the usage of those it is given so keep a copy.
+        measured = {user.id: deepcopy(user) for user in stats}
+        costs: Dict[int, int] = {}
+        if args.policy == "cost":
+            self.ctx.err("Estimating the cost of deleting each user's data.")
+            costs = estimate_costs(self.gateway, list(measured))
+        users = self.choose(args, file_count, file_size, stats, costs)
+        if args.verify == 0 or not args.force:
+            if args.verify > 0:
+                self.ctx.err("Not verifying deletion in dry-run mode.")
+            self.delete_users(args, users, pool)
+            return users
+
+        free_before = free_space(self.gateway, args.path)
+        self.delete_users(args, users, pool)
+        deleted = list(users)
+        remeasured: List[UserStats] = []
+        for verify_round in range(args.verify + 1):
+            remeasured.extend(remeasure(self.gateway, users, pool))
+            remaining_count, remaining_size = shortfall(
+                file_count, file_size, measured, remeasured
             )
-            users = choose_users(args.inodes, args.gigabytes * 1000**3, stats)
-            self.ctx.err(f"Found {len(users)} user(s) for deletion.")
-            for user in users:
+            planned_count = sum(measured[user.id].count for user in deleted)
+            planned_size = sum(measured[user.id].size for user in deleted)
+            self.ctx.err(
+                f"Planned to delete {planned_count:,} files and {planned_size:,}"
+                f" bytes; {remaining_count:,} files and {remaining_size:,} bytes"
+                " remain to be deleted."
+            )
+            if remaining_count == 0 and remaining_size == 0:
+                break
+            if verify_round == args.verify:
+                self.ctx.err("Still short of the target after verifying.")
+                break
+            chosen = {user.id for user in deleted}
+            candidates = [
+                deepcopy(user) for user in measured.values() if user.id not in chosen
+            ]
+            users = self.choose(
+                args, remaining_count, remaining_size, candidates, costs
+            )
+            if not users:
+                self.ctx.err("No more users can be chosen for deletion.")
+                break
+            self.delete_users(args, users, pool)
+            deleted.extend(users)
+
+        free_count, free_size = free_space(self.gateway, args.path)
+        if args.path:
+            self.ctx.err(f"Free inodes went from {free_before[0]:,} to {free_count:,}.")
+        self.ctx.err(f"Free bytes went from {free_before[1]:,} to {free_size:,}.")
+        return deleted
+
+    def choose(
+        self,
+        args: argparse.Namespace,
+        file_count: int,
+        file_size: int,
+        stats: List[UserStats],
+        costs: Dict[int, int],
+    ) -> List[UserStats]:
+        if args.policy == "cost":
+            return choose_users_by_cost(file_count, file_size, stats, costs)
+        return choose_users(file_count, file_size, stats)
+
+    def delete_users(
+        self,
+        args: argparse.Namespace,
+        users: List[UserStats],
+        pool: Optional[SessionPool] = None,
+    ) -> None:
+        dry_run = not args.force
+        plan_only = dry_run and args.dry_run_level == "plan"
+        expected: Dict[str, Dict[str, int]] = {}
+        if args.force and args.counts_file:
+            if os.path.exists(args.counts_file):
+                with open(args.counts_file) as f:
+                    expected = json.load(f)
+            else:
                 self.ctx.err(
-                    'Deleting {} GB of data belonging to "{}" (#{}).'.format(
-                        user.size / 1000**3,
-                        user.name,
-                        user.id,
-                    )
+                    f"No expected counts loaded: {args.counts_file} not found."
+                    " Deleted objects will be reported without comparison."
                 )
-                dry_run = not args.force
-                if dry_run:
-                    self.ctx.err("Despite output, will not actually delete any data.")
+        counts: Dict[str, Dict[str, int]] = {}
+
+        self.ctx.err(f"Found {len(users)} user(s) for deletion.")
+        for user in users:
+            if plan_only:
+                self.ctx.err(
+                    f"Planning deletion of {user.size / 1000**3} GB of data"
+                    f' belonging to "{user.name}" (#{user.id}).'
+                )
+                self.ctx.err("Planning only: will not ask the server to check.")
+                targets = count_objects(find_targets(self.gateway, user.id, pool))
+                self.report_counts("Would target", targets)
+                continue
+            self.ctx.err(
+                'Deleting {} GB of data belonging to "{}" (#{}).'.format(
+                    user.size / 1000**3,
+                    user.name,
+                    user.id,
+                )
+            )
+            if dry_run:
+                self.ctx.err("Despite output, will not actually delete any data.")
+            else:
+                self.ctx.err("Running for real: will actually delete data.")
+            user_expected = expected.get(str(user.id), {})
+            if user_expected:
+                self.report_counts("Expecting to delete", user_expected)
+            deleted = delete_data(self.gateway, user.id, dry_run=dry_run, pool=pool)
+            counts[str(user.id)] = deleted
+            if dry_run:
+                self.report_counts("Would delete", deleted)
+            else:
+                self.report_counts("Deleted", deleted, user_expected)
+
+        if dry_run and not plan_only and args.counts_file:
+            with open(args.counts_file, "w") as f:
+                json.dump(counts, f, indent=2, sort_keys=True)
+            self.ctx.err(f"Saved object counts to {args.counts_file}.")
+
+    def report_counts(
+        self,
+        action: str,
+        counts: Dict[str, int],
+        expected: Optional[Dict[str, int]] = None,
+    ) -> None:
+        total = sum(counts.values())
+        if expected:
+            self.ctx.err(
+                f"{action} {total:,} of {sum(expected.values()):,} expected objects."
+            )
+        else:
+            self.ctx.err(f"{action} {total:,} objects.")
+        for object_class in sorted(set(counts) | set(expected or {})):
+            line = f"  {object_class}: {counts.get(object_class, 0):,}"
+            if expected:
+                line += f" of {expected.get(object_class, 0):,}"
+            self.ctx.err(line)
+
+    def reject_options(
+        self,
+        args: argparse.Namespace,
+        mode: str,
+        options: Tuple[Tuple[str, str, Any], ...],
+    ) -> None:
+        # Stop rather than silently ignore options that do not apply.
+        unsupported = [
+            option
+            for option, dest, default in options
+            if getattr(args, dest) != default
+        ]
+        if unsupported:
+            self.ctx.die(28, f"Cannot use {', '.join(unsupported)} with {mode}")
+
+    def watch(self, args: argparse.Namespace) -> None:
+        self.reject_options(
+            args,
+            "--watch: set --free-inodes or --free-gigabytes instead",
+            (("--inodes", "inodes", 0), ("--gigabytes", "gigabytes", 0)),
+        )
+        if args.free_inodes == 0 and args.free_gigabytes == 0:
+            self.ctx.die(23, "Please specify how much space to keep free")
+        if args.free_inodes > 0 and not args.path:
+            self.ctx.die(24, "Please specify --path to keep inodes free")
+        if args.interval <= 0 or args.cooldown <= 0:
+            self.ctx.die(27, "Please specify a positive --interval and --cooldown")
+
+        where = args.path or "the binary repository"
+        self.ctx.err(
+            f"Watching {where} every {args.interval} seconds"
+            f" with {args.cooldown} seconds between cleanups."
+        )
+        cache = UsageCache()
+        try:
+            while True:
+                # A failed cleanup is reported and retried after the cooldown.
+                try:
+                    cleaned = self.watch_once(args, cache)
+                except (
+                    omero.ServerError,  # type: ignore[attr-defined]
+                    omero.ClientError,  # type: ignore[attr-defined]
+                    Ice.Exception,
+                    ValueError,
+                    SystemExit,
+                ) as e:
+                    self.ctx.err(f"Cleanup failed: {str(e) or type(e).__name__}")
+                    cleaned = True
+                if cleaned:
+                    sleep(max(args.cooldown, args.interval))
                 else:
-                    self.ctx.err("Running for real: will actually delete data.")
-                delete_data(self.gateway, user.id, dry_run=dry_run)
+                    sleep(args.interval)
         except KeyboardInterrupt:
             pass  # ignore
+
+    def watch_once(self, args: argparse.Namespace, cache: UsageCache) -> bool:
+        # Poll the free space once and clean up if needed.
+        # Returns if a cleanup was attempted.
+        self.gateway.keepAlive()
+        free_count, free_size = free_space(self.gateway, args.path)
+        excess_count, excess_size = excess(
+            args.free_inodes, args.free_gigabytes * 1000**3, free_count, free_size
+        )
+        if excess_count == 0 and excess_size == 0:
+            return False
+
+        self.ctx.err(
+            f"Need to delete at least {excess_count:,} files"
+            f" and {excess_size:,} bytes of data."
+        )
+        # Users may have been tagged to be ignored since the last cleanup.
+        ignore = users_by_tag(self.gateway, args.ignore_tag)
+        ignore.extend(users_by_id_or_username(self.gateway, args.ignore_users))
+        with self.session_pool(args) as pool:
+            stats = cache.refresh(
+                self.gateway, minimum_days=args.days, ignore_users=ignore, pool=pool
+            )
+            users = self.delete_and_verify(args, excess_count, excess_size, stats, pool)
+        if args.force:
+            for user in users:
+                cache.forget(user.id)
+        return True
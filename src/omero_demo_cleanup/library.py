@@ -20,10 +20,30 @@
 # Delete users' data to free space on the server.
 # author: m.t.b.carroll@dundee.ac.uk
 
+import heapq
+import os
 import sys
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from configparser import ConfigParser
+from contextlib import redirect_stdout
+from copy import deepcopy
+from multiprocessing import get_context
+from queue import Queue
 from time import time
-from typing import Dict, List, Tuple
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    Iterable,
+    List,
+    Optional,
+    Set,
+    TextIO,
+    Tuple,
+    TypeVar,
+)
 
+import Ice
 import omero
 import omero.clients
 from omero.cmd import (
@@ -39,9 +59,12 @@ from omero.gateway import BlitzGateway
 from omero.model import Experimenter
 from omero.plugins import hql  # type: ignore[attr-defined] # noqa
 from omero.rtypes import rlong, unwrap
-from omero.sys import ParametersI
+from omero.sys import ParametersI, Principal
+
+T = TypeVar("T")
 
-# If adjusting UserStats, find_worst, choose_users then check with unit tests.
+# If adjusting UserStats, find_worst, choose_users, choose_users_by_cost
+# then check with unit tests.
 
 
 class UserStats:
@@ -112,12 +135,57 @@ def choose_users(
     return to_delete
 
 
+def choose_users_by_cost(
+    file_count: int,
+    file_size: int,
+    user_stats: List[UserStats],
+    costs: Dict[int, int],
+) -> List[UserStats]:
+    # Greedily choose the users who free the most per cost of deleting them
+    # until enough data would be deleted. The benefit of a user is the share
+    # of each target they would still meet so it can only fall as users are
+    # chosen: a stale priority from the heap is an upper bound, letting a user
+    # be taken once their fresh priority still beats the next stale one.
+    remaining_count = file_count
+    remaining_size = file_size
+
+    def priority(user: UserStats) -> float:
+        benefit = 0.0
+        if remaining_count > 0:
+            benefit += min(user.count, remaining_count) / file_count
+        if remaining_size > 0:
+            benefit += min(user.size, remaining_size) / file_size
+        return benefit / (1 + costs.get(user.id, 0))
+
+    heap = [
+        (-priority(user), user.logout, index, user)
+        for index, user in enumerate(user_stats)
+    ]
+    heapq.heapify(heap)
+    to_delete: List[UserStats] = []
+    while heap and (remaining_count > 0 or remaining_size > 0):
+        _, logout, index, user = heapq.heappop(heap)
+        fresh = priority(user)
+        if fresh <= 0:
+            continue
+        if heap and -fresh > heap[0][0]:
+            heapq.heappush(heap, (-fresh, logout, index, user))
+            continue
+        to_delete.append(user)
+        remaining_count -= user.count
+        remaining_size -= user.size
+    return to_delete
+
+
 def submit(
-    conn: BlitzGateway, request: Delete2, expected: Delete2Response
+    conn: BlitzGateway,
+    request: Delete2,
+    expected: Delete2Response,
+    ctx: Optional[Dict[str, str]] = None,
 ) -> HandlePrx:
     # Submit a request and wait for it to complete.
     # Returns with the response only if it was of the given type.
-    cb = conn.c.submit(request, loops=500)
+    cb = conn.c.submit(request, loops=500, ctx=ctx)
     try:
         rsp = cb.getResponse()
     finally:
@@ -162,25 +230,162 @@ def get_delete_classes(conn: BlitzGateway) -> List[str]:
     return delete_classes
 
 
-def delete_data(conn: BlitzGateway, user_id: int, dry_run: bool = True) -> None:
-    # Delete all the data of the given user. Respects the state of dry_run.
+class SessionPool:
+    # Extra sessions of the same user for running group-scoped queries
+    # side by side. Each session serves one shard at a time. The sessions have
+    # no time limit and are kept alive while idle, e.g. during a long Delete2.
+
+    def __init__(
+        self, conn: BlitzGateway, size: int, idle_timeout: int = 600000
+    ) -> None:
+        principal = Principal()
+        principal.name = conn.getUser().getName()
+        principal.group = conn.getGroupFromContext().getName()
+        principal.eventType = "User"
+        self.size = size
+        self.gateways: List[BlitzGateway] = []
+        self.idle: "Queue[BlitzGateway]" = Queue()
+        for _ in range(size):
+            session = conn.getSessionService().createSessionWithTimeouts(
+                principal, 0, idle_timeout
+            )
+            client = omero.client(  # type: ignore[attr-defined]
+                host=conn.host, port=int(conn.port)
+            )
+            client.joinSession(session.getUuid().val)
+            client.enableKeepAlive(idle_timeout // 4000)
+            gateway = BlitzGateway(client_obj=client)
+            self.gateways.append(gateway)
+            self.idle.put(gateway)
+
+    def map(self, func: Callable[..., T], shards: Iterable[Any]) -> List[T]:
+        # Call func(conn, shard) for each shard on the next idle session.
+        def run(shard: Any) -> T:
+            gateway = self.idle.get()
+            try:
+                return func(gateway, shard)
+            finally:
+                self.idle.put(gateway)
+
+        with ThreadPoolExecutor(max_workers=self.size) as executor:
+            return list(executor.map(run, shards))
+
+    def close(self) -> None:
+        for gateway in self.gateways:
+            gateway.close(hard=True)
+        self.gateways = []
+
+    def __enter__(self) -> "SessionPool":
+        return self
+
+    def __exit__(self, *args: Any) -> None:
+        self.close()
+
+
+def find_groups(conn: BlitzGateway, user_ids: List[int]) -> Dict[int, List[int]]:
+    # The groups by which to shard queries, each with those of the given users
+    # who may own data there: the groups they belong to and any others, e.g.
+    # that they have left, in which they still own files.
     all_groups = {"omero.group": "-1"}
     params = ParametersI()
+    params.addIds(user_ids)
+    owners: Dict[int, Set[int]] = {}
+    for query, ctx in (
+        (
+            "SELECT parent.id, child.id FROM GroupExperimenterMap"
+            " WHERE child.id IN (:ids)",
+            None,
+        ),
+        (
+            "SELECT DISTINCT details.group.id, details.owner.id FROM OriginalFile"
+            " WHERE details.owner.id IN (:ids)",
+            all_groups,
+        ),
+    ):
+        for result in conn.getQueryService().projection(query, params, ctx):
+            owners.setdefault(result[0].val, set()).add(result[1].val)
+    return {group_id: sorted(owner_ids) for group_id, owner_ids in owners.items()}
+
+
+def owned_objects(
+    conn: BlitzGateway, user_id: int, delete_classes: List[str], group_id: int = -1
+) -> Dict[str, List[int]]:
+    # Find the IDs of the given user's objects, in one group or in all.
+    group = {"omero.group": str(group_id)}
+    params = ParametersI()
     params.addId(rlong(user_id))
-    delete = Delete2(dryRun=dry_run, targetObjects={})
-    for delete_class in get_delete_classes(conn):
+    targets = {}
+    for delete_class in delete_classes:
         object_ids = []
         for result in conn.getQueryService().projection(
             f"SELECT id FROM {delete_class} WHERE details.owner.id = :id",
             params,
-            all_groups,
+            group,
         ):
             object_id = result[0].val
             object_ids.append(object_id)
         if object_ids:
-            delete.targetObjects[delete_class] = object_ids
-    if delete.targetObjects:
-        submit(conn, delete, Delete2Response)
+            targets[delete_class] = object_ids
+    return targets
+
+
+def find_targets(
+    conn: BlitzGateway, user_id: int, pool: Optional[SessionPool] = None
+) -> Dict[str, List[int]]:
+    # Find the objects to delete for the given user.
+    # With a pool the objects are found group by group on its sessions.
+    delete_classes = get_delete_classes(conn)
+    if pool is None:
+        return owned_objects(conn, user_id, delete_classes)
+    all_targets: Dict[str, List[int]] = {}
+    for targets in pool.map(
+        lambda shard_conn, group_id: owned_objects(
+            shard_conn, user_id, delete_classes, group_id
+        ),
+        list(find_groups(conn, [user_id])),
+    ):
+        for delete_class, object_ids in targets.items():
+            all_targets.setdefault(delete_class, []).extend(object_ids)
+    return all_targets
+
+
+def estimate_costs(conn: BlitzGateway, user_ids: List[int]) -> Dict[int, int]:
+    # Estimate how costly each user is to delete by counting their objects.
+    costs = {user_id: 0 for user_id in user_ids}
+    if not user_ids:
+        return costs
+    all_groups = {"omero.group": "-1"}
+    params = ParametersI()
+    params.addIds(user_ids)
+    for delete_class in get_delete_classes(conn):
+        for result in conn.getQueryService().projection(
+            f"SELECT details.owner.id, COUNT(id) FROM {delete_class}"
+            " WHERE details.owner.id IN (:ids) GROUP BY details.owner.id",
+            params,
+            all_groups,
+        ):
+            costs[result[0].val] += result[1].val
+    return costs
+
+
+def count_objects(objects: Dict[str, List[int]]) -> Dict[str, int]:
+    # Summarize objects by how many there are of each class.
+    return {object_class: len(ids) for object_class, ids in objects.items() if ids}
+
+
+def delete_data(
+    conn: BlitzGateway,
+    user_id: int,
+    dry_run: bool = True,
+    pool: Optional[SessionPool] = None,
+) -> Dict[str, int]:
+    # Delete all the data of the given user. Respects the state of dry_run.
+    # Returns how many objects of each class were, or would be, deleted.
+    delete = Delete2(dryRun=dry_run, targetObjects=find_targets(conn, user_id, pool))
+    if not delete.targetObjects:
+        return {}
+    rsp = submit(conn, delete, Delete2Response)
+    return count_objects(rsp.deletedObjects)
 
 
 def exp_to_str(exp: Experimenter) -> str:
@@ -307,36 +512,176 @@ def find_users(
     return users, logouts
 
 
+def user_usage(conn: BlitzGateway, user_id: int) -> Tuple[int, int]:
+    # Count the files and bytes owned by the given user.
+    user = {"Experimenter": [user_id]}
+    rsp = submit(conn, DiskUsage2(targetObjects=user), DiskUsage2Response)
+
+    file_count = 0
+    file_size = 0
+
+    for who, usage in rsp.totalFileCount.items():
+        if who.first == user_id:
+            file_count += usage
+    for who, usage in rsp.totalBytesUsed.items():
+        if who.first == user_id:
+            file_size += usage
+    return file_count, file_size
+
+
+def group_usage(
+    conn: BlitzGateway, group_id: int, user_ids: List[int]
+) -> Dict[int, Tuple[int, int]]:
+    # Count the files and bytes owned by the given users in the given group.
+    print(f"Finding disk usage of {len(user_ids)} user(s) in group #{group_id}.")
+    users = {"Experimenter": user_ids}
+    group = {"omero.group": str(group_id)}
+    rsp = submit(conn, DiskUsage2(targetObjects=users), DiskUsage2Response, group)
+
+    file_counts: Dict[int, int] = {}
+    file_sizes: Dict[int, int] = {}
+
+    for who, usage in rsp.totalFileCount.items():
+        if who.second == group_id:
+            file_counts[who.first] = file_counts.get(who.first, 0) + usage
+    for who, usage in rsp.totalBytesUsed.items():
+        if who.second == group_id:
+            file_sizes[who.first] = file_sizes.get(who.first, 0) + usage
+    return {
+        user_id: (file_counts.get(user_id, 0), file_sizes.get(user_id, 0))
+        for user_id in user_ids
+    }
+
+
+def sharded_usage(
+    conn: BlitzGateway, pool: SessionPool, user_ids: List[int]
+) -> Dict[int, Tuple[int, int]]:
+    # Count the files and bytes owned by the given users, group by group,
+    # then total each user's usage across their groups.
+    usage = {user_id: (0, 0) for user_id in user_ids}
+    if not user_ids:
+        return usage
+    owners = find_groups(conn, user_ids)
+    for group in pool.map(
+        lambda shard_conn, shard: group_usage(shard_conn, *shard), owners.items()
+    ):
+        for user_id, (file_count, file_size) in group.items():
+            total_count, total_size = usage[user_id]
+            usage[user_id] = (total_count + file_count, total_size + file_size)
+    return usage
+
+
+def measure(
+    conn: BlitzGateway, users: Dict[int, str], pool: Optional[SessionPool] = None
+) -> Dict[int, Tuple[int, int]]:
+    # Count the files and bytes owned by each of the given users.
+    if pool is not None:
+        return sharded_usage(conn, pool, list(users))
+    usage = {}
+    for user_id, user_name in users.items():
+        print(f'Finding disk usage of "{user_name}" (#{user_id}).')
+        usage[user_id] = user_usage(conn, user_id)
+    return usage
+
+
 def resource_usage(
-    conn: BlitzGateway, minimum_days: int = 0, ignore_users: List[int] = []
+    conn: BlitzGateway,
+    minimum_days: int = 0,
+    ignore_users: List[int] = [],
+    pool: Optional[SessionPool] = None,
 ) -> List[UserStats]:
     # Note users' resource usage.
     # DiskUsage2.targetClasses remains too inefficient so iterate.
-
-    user_stats = []
-    users, logouts = find_users(
-        conn, minimum_days=minimum_days, ignore_users=ignore_users
+    return UsageCache().refresh(
+        conn, minimum_days=minimum_days, ignore_users=ignore_users, pool=pool
     )
-    for user_id, user_name in users.items():
-        print(f'Finding disk usage of "{user_name}" (#{user_id}).')
-        user = {"Experimenter": [user_id]}
-        rsp = submit(conn, DiskUsage2(targetObjects=user), DiskUsage2Response)
-
-        file_count = 0
-        file_size = 0
-
-        for who, usage in rsp.totalFileCount.items():
-            if who.first == user_id:
-                file_count += usage
-        for who, usage in rsp.totalBytesUsed.items():
-            if who.first == user_id:
-                file_size += usage
-
-        if file_count > 0 or file_size > 0:
-            user_stats.append(
-                UserStats(user_id, user_name, file_count, file_size, logouts[user_id])
+
+
+def remeasure(
+    conn: BlitzGateway, users: List[UserStats], pool: Optional[SessionPool] = None
+) -> List[UserStats]:
+    # Note the given users' resource usage anew, e.g. after deletion.
+    usage = measure(conn, {user.id: user.name for user in users}, pool)
+    return [
+        UserStats(user.id, user.name, *usage[user.id], user.logout) for user in users
+    ]
+
+
+def shortfall(
+    file_count: int,
+    file_size: int,
+    measured: Dict[int, UserStats],
+    remeasured: List[UserStats],
+) -> Tuple[int, int]:
+    # How much remains to delete given users' usage before and after deletion.
+    for user in remeasured:
+        file_count -= measured[user.id].count - user.count
+        file_size -= measured[user.id].size - user.size
+    return max(0, file_count), max(0, file_size)
+
+
+class UsageCache:
+    # Remembers users' resource usage between scans.
+    # A user is measured again only once they have logged out since last
+    # measured so repeated scans need little more than find_users.
+
+    def __init__(self) -> None:
+        self.stats: Dict[int, UserStats] = {}
+
+    def refresh(
+        self,
+        conn: BlitzGateway,
+        minimum_days: int = 0,
+        ignore_users: List[int] = [],
+        pool: Optional[SessionPool] = None,
+    ) -> List[UserStats]:
+        # Returns copies so that choose_users cannot alter the cached values.
+        user_stats = []
+        users, logouts = find_users(
+            conn, minimum_days=minimum_days, ignore_users=ignore_users
+        )
+        stale = {
+            user_id: user_name
+            for user_id, user_name in users.items()
+            if user_id not in self.stats
+            or self.stats[user_id].logout != logouts.get(user_id, 0)
+        }
+        for user_id, usage in measure(conn, stale, pool).items():
+            self.stats[user_id] = UserStats(
+                user_id, stale[user_id], *usage, logouts.get(user_id, 0)
             )
-    return user_stats
+        for user_id in users:
+            cached = self.stats[user_id]
+            if cached.count > 0 or cached.size > 0:
+                user_stats.append(deepcopy(cached))
+        return user_stats
+
+    def forget(self, user_id: int) -> None:
+        # Measure the user again on the next refresh, e.g. after deletion.
+        self.stats.pop(user_id, None)
+
+
+def free_space(conn: BlitzGateway, path: Optional[str] = None) -> Tuple[int, int]:
+    # Note the free inodes and bytes of the given path or else of the binary
+    # repository. The server does not report free inodes so -1 is given.
+    if path:
+        stat = os.statvfs(path)
+        return stat.f_favail, stat.f_bavail * stat.f_frsize
+    return -1, conn.getFreeSpace()
+
+
+def excess(
+    watermark_inodes: int, watermark_bytes: int, free_count: int, free_size: int
+) -> Tuple[int, int]:
+    # How many files and bytes to delete for the free inodes and bytes to reach
+    # the given watermarks. A watermark of 0 is not watched.
+    excess_count = 0
+    excess_size = 0
+    if watermark_inodes > 0:
+        excess_count = max(0, watermark_inodes - free_count)
+    if watermark_bytes > 0:
+        excess_size = max(0, watermark_bytes - free_size)
+    return excess_count, excess_size
 
 
 def perform_delete(
@@ -361,6 +706,181 @@ def perform_delete(
         delete_data(conn, user.id, dry_run=dry_run)
 
 
+class ServerProfile:
+    # How to log in to a server and how much to delete there.
+
+    def __init__(
+        self,
+        name: str,
+        host: str,
+        port: int = 4064,
+        user: str = "root",
+        password: Optional[str] = None,
+        session: Optional[str] = None,
+        inodes: int = 0,
+        gigabytes: int = 0,
+        days: int = 0,
+        ignore_tag: str = "NO DELETE",
+        ignore_users: str = "",
+    ) -> None:
+        self.name = name
+        self.host = host
+        self.port = port
+        self.user = user
+        self.password = password
+        self.session = session
+        self.inodes = inodes
+        self.gigabytes = gigabytes
+        self.days = days
+        self.ignore_tag = ignore_tag
+        self.ignore_users = ignore_users
+
+
+class ServerReport:
+    # The outcome of cleaning up one server.
+
+    def __init__(self, name: str) -> None:
+        self.name = name
+        self.users: List[UserStats] = []
+        self.deleted: Dict[str, int] = {}
+        self.scan_seconds = 0.0
+        self.delete_seconds = 0.0
+        self.error: Optional[str] = None
+
+
+def read_servers(path: str) -> List[ServerProfile]:
+    # Read server profiles from an INI file, one section per server.
+    parser = ConfigParser(interpolation=None)
+    if not parser.read(path):
+        raise ValueError(f"Servers file: {path} not found")
+    profiles = []
+    for name in parser.sections():
+        section = parser[name]
+        if "host" not in section:
+            raise ValueError(f"Server: {name} has no host")
+        if "password" not in section and "session" not in section:
+            raise ValueError(f"Server: {name} has no password or session")
+        profiles.append(
+            ServerProfile(
+                name,
+                section["host"],
+                port=section.getint("port", 4064),
+                user=section.get("user", "root"),
+                password=section.get("password"),
+                session=section.get("session"),
+                inodes=section.getint("inodes", 0),
+                gigabytes=section.getint("gigabytes", 0),
+                days=section.getint("days", 0),
+                ignore_tag=section.get("ignore_tag", "NO DELETE"),
+                ignore_users=section.get("ignore_users", ""),
+            )
+        )
+    return profiles
+
+
+class PrefixedOutput:
+    # Writes whole lines to the given stream, each starting with the prefix,
+    # so that the output of servers cleaned up side by side can be told apart.
+
+    def __init__(self, stream: TextIO, prefix: str) -> None:
+        self.stream = stream
+        self.prefix = prefix
+        self.line = ""
+
+    def write(self, text: str) -> int:
+        self.line += text
+        *lines, self.line = self.line.split("\n")
+        for line in lines:
+            self.stream.write(f"{self.prefix}{line}\n")
+        if lines:
+            self.stream.flush()
+        return len(text)
+
+    def flush(self) -> None:
+        if self.line:
+            self.stream.write(f"{self.prefix}{self.line}")
+            self.line = ""
+        self.stream.flush()
+
+
+def cleanup_server(profile: ServerProfile, dry_run: bool = True) -> ServerReport:
+    # Perform data deletion on one server with its own connection.
+    # Whatever is done before any failure is still reported.
+    output = PrefixedOutput(sys.stdout, f"[{profile.name}] ")
+    with redirect_stdout(output):
+        report = ServerReport(profile.name)
+        client = omero.client(  # type: ignore[attr-defined]
+            host=profile.host, port=profile.port
+        )
+        try:
+            if profile.session:
+                client.joinSession(profile.session)
+            else:
+                client.createSession(profile.user, profile.password)
+            conn = BlitzGateway(client_obj=client)
+            conn.SERVICE_OPTS.setOmeroGroup("-1")
+
+            start = time()
+            ignore = users_by_tag(conn, profile.ignore_tag)
+            ignore.extend(users_by_id_or_username(conn, profile.ignore_users))
+            stats = resource_usage(conn, minimum_days=profile.days, ignore_users=ignore)
+            measured = {user.id: deepcopy(user) for user in stats}
+            users = choose_users(profile.inodes, profile.gigabytes * 1000**3, stats)
+            report.users = [measured[user.id] for user in users]
+            report.scan_seconds = time() - start
+
+            start = time()
+            for user in users:
+                for delete_class, count in delete_data(conn, user.id, dry_run).items():
+                    report.deleted[delete_class] = (
+                        report.deleted.get(delete_class, 0) + count
+                    )
+                report.delete_seconds = time() - start
+        except (
+            omero.ServerError,  # type: ignore[attr-defined]
+            omero.ClientError,  # type: ignore[attr-defined]
+            Ice.Exception,
+            ValueError,
+            SystemExit,
+        ) as e:
+            report.error = str(e) or type(e).__name__
+        finally:
+            if profile.session:
+                client.closeSession()
+            else:
+                client.killSession()
+            output.flush()
+    return report
+
+
+def fan_out(
+    profiles: List[ServerProfile], dry_run: bool = True, workers: int = 0
+) -> List[ServerReport]:
+    # Clean up each server in its own process, all at the same time.
+    # Processes are spawned rather than forked so that each starts Ice afresh.
+    if not profiles:
+        return []
+    # A server whose process fails still gets a report, with the error.
+    reports: List[Optional[ServerReport]] = [None] * len(profiles)
+    with ProcessPoolExecutor(
+        max_workers=workers or len(profiles), mp_context=get_context("spawn")
+    ) as executor:
+        futures = {
+            executor.submit(cleanup_server, profile, dry_run): index
+            for index, profile in enumerate(profiles)
+        }
+        for future in as_completed(futures):
+            index = futures[future]
+            error = future.exception()
+            if error is None:
+                reports[index] = future.result()
+            else:
+                report = ServerReport(profiles[index].name)
+                report.error = str(error) or type(error).__name__
+                reports[index] = report
+    return [report for report in reports if report is not None]
+
+
 def main() -> None:
     with omero.cli.cli_login() as cli:  # type: ignore[attr-defined]
         conn = omero.gateway.BlitzGateway(client_obj=cli.get_client())
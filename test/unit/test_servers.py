@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+
+# Copyright (C) 2026 University of Dundee & Open Microscopy Environment.
+# All rights reserved.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+import socket
+from io import StringIO
+from pathlib import Path
+
+import pytest
+from omero_demo_cleanup.library import (
+    PrefixedOutput,
+    ServerProfile,
+    fan_out,
+    read_servers,
+)
+
+
+def closed_port() -> int:
+    # A local port on which nothing is listening.
+    with socket.socket() as sock:
+        sock.bind(("localhost", 0))
+        return sock.getsockname()[1]
+
+
+class TestServers:
+    # Run tests on "read_servers".
+
+    def test_read_servers(self, tmp_path: Path) -> None:
+        path = tmp_path / "servers.ini"
+        path.write_text(
+            "[demo]\n"
+            "host = demo.example.org\n"
+            "password = secret\n"
+            "gigabytes = 300\n"
+            "[training]\n"
+            "host = localhost\n"
+            "port = 14064\n"
+            "user = admin\n"
+            "session = abc\n"
+            "inodes = 1000\n"
+            "days = 7\n"
+            "ignore_users = 2,ben\n"
+        )
+        demo, training = read_servers(str(path))
+        assert (demo.name, demo.host, demo.port, demo.user) == (
+            "demo",
+            "demo.example.org",
+            4064,
+            "root",
+        )
+        assert (demo.password, demo.session) == ("secret", None)
+        assert (demo.gigabytes, demo.inodes, demo.days) == (300, 0, 0)
+        assert demo.ignore_tag == "NO DELETE"
+        assert (training.port, training.user, training.session) == (
+            14064,
+            "admin",
+            "abc",
+        )
+        assert (training.inodes, training.days) == (1000, 7)
+        assert training.ignore_users == "2,ben"
+
+    def test_percent_in_password(self, tmp_path: Path) -> None:
+        path = tmp_path / "servers.ini"
+        path.write_text("[demo]\nhost = localhost\npassword = 100%sure\n")
+        (demo,) = read_servers(str(path))
+        assert demo.password == "100%sure"
+
+    @pytest.mark.parametrize(
+        "text", ["[demo]\npassword = secret\n", "[demo]\nhost = localhost\n"]
+    )
+    def test_incomplete_server(self, tmp_path: Path, text: str) -> None:
+        path = tmp_path / "servers.ini"
+        path.write_text(text)
+        with pytest.raises(ValueError):
+            read_servers(str(path))
+
+    def test_missing_file(self, tmp_path: Path) -> None:
+        with pytest.raises(ValueError):
+            read_servers(str(tmp_path / "servers.ini"))
+
+
+class TestFanOut:
+    # Run tests on "fan_out" against a stand-in server that is not there.
+
+    def test_unreachable_servers(self) -> None:
+        port = closed_port()
+        profiles = [
+            ServerProfile("first", "localhost", port=port, password="secret"),
+            ServerProfile("second", "localhost", port=port, password="secret"),
+        ]
+        reports = fan_out(profiles, workers=2)
+        assert [report.name for report in reports] == ["first", "second"]
+        for report in reports:
+            assert report.error
+            assert report.users == []
+            assert report.deleted == {}
+
+    def test_no_servers(self) -> None:
+        assert fan_out([]) == []
+
+
+class TestPrefixedOutput:
+    # Run tests on "PrefixedOutput".
+
+    def test_prefixes_lines(self) -> None:
+        stream = StringIO()
+        output = PrefixedOutput(stream, "[demo] ")
+        output.write("Finding disk usage")
+        assert stream.getvalue() == ""
+        output.write(' of "user-1" (#2).\nIgnoring')
+        output.write(" 0 users.\n")
+        output.write("Done")
+        output.flush()
+        assert stream.getvalue() == (
+            '[demo] Finding disk usage of "user-1" (#2).\n'
+            "[demo] Ignoring 0 users.\n"
+            "[demo] Done"
+        )
@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+
+# Copyright (C) 2026 University of Dundee & Open Microscopy Environment.
+# All rights reserved.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+from typing import Any, Callable, Dict, Iterable, List, Tuple
+
+import pytest
+from omero_demo_cleanup import library
+from omero_demo_cleanup.library import find_targets, sharded_usage
+
+
+class FakePool:
+    # Runs each shard in turn, noting the shards.
+
+    def __init__(self) -> None:
+        self.shards: List[Any] = []
+
+    def map(self, func: Callable[..., Any], shards: Iterable[Any]) -> List[Any]:
+        self.shards = list(shards)
+        return [func(None, shard) for shard in self.shards]
+
+
+class TestSharding:
+    # Run tests on "sharded_usage" and "find_targets" with the server queries
+    # replaced: users 1 and 2 own data in group 10, user 2 also in group 20.
+
+    groups = {10: [1, 2], 20: [2]}
+
+    @pytest.fixture(autouse=True)
+    def server(self, monkeypatch: pytest.MonkeyPatch) -> None:
+        usage = {
+            10: {1: (1, 10), 2: (2, 20)},
+            20: {2: (3, 30)},
+        }
+        objects = {
+            (10, 2): {"Image": [1, 2], "Dataset": [3]},
+            (20, 2): {"Image": [4]},
+        }
+
+        def find_groups(conn: Any, user_ids: List[int]) -> Dict[int, List[int]]:
+            return {
+                group_id: [user_id for user_id in owners if user_id in user_ids]
+                for group_id, owners in self.groups.items()
+                if any(user_id in user_ids for user_id in owners)
+            }
+
+        def group_usage(
+            conn: Any, group_id: int, user_ids: List[int]
+        ) -> Dict[int, Tuple[int, int]]:
+            return {user_id: usage[group_id][user_id] for user_id in user_ids}
+
+        def owned_objects(
+            conn: Any, user_id: int, delete_classes: List[str], group_id: int = -1
+        ) -> Dict[str, List[int]]:
+            return objects.get((group_id, user_id), {})
+
+        monkeypatch.setattr(library, "find_groups", find_groups)
+        monkeypatch.setattr(library, "group_usage", group_usage)
+        monkeypatch.setattr(library, "owned_objects", owned_objects)
+        monkeypatch.setattr(library, "get_delete_classes", lambda conn: ["Image"])
+
+    def test_sharded_usage(self) -> None:
+        pool = FakePool()
+        usage = sharded_usage(None, pool, [1, 2, 3])  # type: ignore[arg-type]
+        assert usage == {1: (1, 10), 2: (5, 50), 3: (0, 0)}
+        assert pool.shards == [(10, [1, 2]), (20, [2])]
+
+    def test_sharded_usage_no_users(self) -> None:
+        pool = FakePool()
+        assert sharded_usage(None, pool, []) == {}  # type: ignore[arg-type]
+        assert pool.shards == []
+
+    def test_find_targets(self) -> None:
+        pool = FakePool()
+        targets = find_targets(None, 2, pool)  # type: ignore[arg-type]
+        assert targets == {"Image": [1, 2, 4], "Dataset": [3]}
+        assert pool.shards == [10, 20]
+
+    def test_find_targets_one_group(self) -> None:
+        pool = FakePool()
+        assert find_targets(None, 1, pool) == {}  # type: ignore[arg-type]
+        assert pool.shards == [10]
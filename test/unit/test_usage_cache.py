@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+
+# Copyright (C) 2026 University of Dundee & Open Microscopy Environment.
+# All rights reserved.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+from typing import Any, Dict, List, Tuple
+
+import pytest
+from omero_demo_cleanup import library
+from omero_demo_cleanup.library import UsageCache, excess
+
+
+class TestUsageCache:
+    # Run tests on "UsageCache" with the server queries replaced.
+
+    @pytest.fixture
+    def server(self, monkeypatch: pytest.MonkeyPatch) -> Dict[str, Any]:
+        server: Dict[str, Any] = {
+            "users": {1: "Alice", 2: "Chloe"},
+            "logouts": {1: 100, 2: 200},
+            "usage": {1: (1, 10), 2: (2, 20)},
+            "measured": [],
+        }
+
+        def find_users(
+            conn: Any, minimum_days: int = 0, ignore_users: List[int] = []
+        ) -> Tuple[Dict[int, str], Dict[int, int]]:
+            return dict(server["users"]), dict(server["logouts"])
+
+        def user_usage(conn: Any, user_id: int) -> Tuple[int, int]:
+            server["measured"].append(user_id)
+            return server["usage"][user_id]
+
+        monkeypatch.setattr(library, "find_users", find_users)
+        monkeypatch.setattr(library, "user_usage", user_usage)
+        return server
+
+    def test_measures_once(self, server: Dict[str, Any]) -> None:
+        cache = UsageCache()
+        first = cache.refresh(None)
+        second = cache.refresh(None)
+        assert server["measured"] == [1, 2]
+        assert [(user.id, user.count, user.size) for user in first] == [
+            (1, 1, 10),
+            (2, 2, 20),
+        ]
+        assert [(user.id, user.count, user.size) for user in second] == [
+            (1, 1, 10),
+            (2, 2, 20),
+        ]
+
+    def test_measures_after_logout(self, server: Dict[str, Any]) -> None:
+        cache = UsageCache()
+        cache.refresh(None)
+        server["logouts"][2] = 300
+        server["usage"][2] = (3, 30)
+        stats = cache.refresh(None)
+        assert server["measured"] == [1, 2, 2]
+        assert [(user.id, user.count, user.size) for user in stats] == [
+            (1, 1, 10),
+            (2, 3, 30),
+        ]
+
+    def test_measures_after_forget(self, server: Dict[str, Any]) -> None:
+        cache = UsageCache()
+        cache.refresh(None)
+        server["usage"][1] = (0, 0)
+        cache.forget(1)
+        stats = cache.refresh(None)
+        assert server["measured"] == [1, 2, 1]
+        assert [user.id for user in stats] == [2]
+
+    def test_returns_copies(self, server: Dict[str, Any]) -> None:
+        cache = UsageCache()
+        for user in cache.refresh(None):
+            user.count = 0
+            user.size = 0
+        stats = cache.refresh(None)
+        assert [(user.count, user.size) for user in stats] == [(1, 10), (2, 20)]
+
+    def test_omits_current_users(self, server: Dict[str, Any]) -> None:
+        cache = UsageCache()
+        cache.refresh(None)
+        del server["users"][1]
+        stats = cache.refresh(None)
+        assert [user.id for user in stats] == [2]
+        assert server["measured"] == [1, 2]
+
+
+class TestExcess:
+    # Run tests on "excess".
+
+    test_cases = [
+        ((0, 0, 5, 50), (0, 0)),
+        ((10, 100, 20, 200), (0, 0)),
+        ((10, 100, 4, 200), (6, 0)),
+        ((10, 100, 20, 40), (0, 60)),
+        ((10, 100, 4, 40), (6, 60)),
+        ((0, 100, -1, 40), (0, 60)),
+        ((10, 0, 4, 40), (6, 0)),
+    ]
+
+    @pytest.mark.parametrize("test_case", test_cases)
+    def test_excess(
+        self, test_case: Tuple[Tuple[int, int, int, int], Tuple[int, int]]
+    ) -> None:
+        arguments, expected = test_case
+        assert excess(*arguments) == expected
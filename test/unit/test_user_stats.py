@@ -18,10 +18,15 @@
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 
 from copy import deepcopy
-from typing import Set, Tuple
+from typing import List, Set, Tuple
 
 import pytest
-from omero_demo_cleanup.library import UserStats, choose_users
+from omero_demo_cleanup.library import (
+    UserStats,
+    choose_users,
+    choose_users_by_cost,
+    shortfall,
+)
 
 
 class TestStats:
@@ -174,3 +179,59 @@ class TestStats:
         chosen = choose_users(file_count, file_size, copied_users)
         actual_names = {user.name for user in chosen}
         assert actual_names == expected_names
+
+
+class TestCostPolicy:
+    # Run tests on "choose_users_by_cost", comparing with "choose_users".
+
+    @pytest.mark.parametrize("test_case", TestStats.test_cases)
+    def test_meets_target(self, test_case: Tuple[int, int, Set[str]]) -> None:
+        file_count, file_size, _ = test_case
+        copied_users = deepcopy(TestStats.test_users)
+        chosen = choose_users_by_cost(file_count, file_size, copied_users, {})
+        assert sum(user.count for user in chosen) >= file_count
+        assert sum(user.size for user in chosen) >= file_size
+
+    def test_prefers_cheap_users(self) -> None:
+        users = [
+            UserStats(1, "Rosie", 1, 100, 0),
+            UserStats(2, "Frank", 1, 60, 0),
+            UserStats(3, "Flora", 1, 50, 0),
+        ]
+        costs = {1: 1000000, 2: 10, 3: 10}
+        by_dominance = choose_users(0, 100, deepcopy(users))
+        by_cost = choose_users_by_cost(0, 100, deepcopy(users), costs)
+        assert {user.name for user in by_dominance} == {"Rosie"}
+        assert {user.name for user in by_cost} == {"Frank", "Flora"}
+        assert sum(costs[user.id] for user in by_cost) < sum(
+            costs[user.id] for user in by_dominance
+        )
+
+    def test_stops_at_target(self) -> None:
+        users = [UserStats(i, f"User{i}", 1, 10, 0) for i in range(10)]
+        chosen = choose_users_by_cost(3, 25, users, {})
+        assert len(chosen) == 3
+
+
+class TestShortfall:
+    # Run tests on "shortfall".
+
+    measured = {
+        1: UserStats(1, "Alice", 4, 40, 0),
+        2: UserStats(2, "Chloe", 2, 20, 0),
+    }
+
+    test_cases = [
+        ([], (6, 60)),
+        ([UserStats(1, "Alice", 0, 0, 0)], (2, 20)),
+        ([UserStats(1, "Alice", 0, 0, 0), UserStats(2, "Chloe", 0, 0, 0)], (0, 0)),
+        ([UserStats(1, "Alice", 1, 5, 0), UserStats(2, "Chloe", 0, 0, 0)], (1, 5)),
+        ([UserStats(1, "Alice", 4, 40, 0), UserStats(2, "Chloe", 2, 0, 0)], (6, 40)),
+    ]
+
+    @pytest.mark.parametrize("test_case", test_cases)
+    def test_shortfall(
+        self, test_case: Tuple[List[UserStats], Tuple[int, int]]
+    ) -> None:
+        remeasured, expected = test_case
+        assert shortfall(6, 60, self.measured, remeasured) == expected